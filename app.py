@@ -1,11 +1,12 @@
 import streamlit as st
 import geopandas as gpd
 import pycountry
-import tempfile
 import os
-import fiona
+import json
+import tempfile
+import numpy as np
+import shapely
 from shapely.geometry import shape, Polygon, MultiPolygon, GeometryCollection
-from shapely.ops import unary_union
 from streamlit_folium import st_folium
 import folium
 from folium.plugins import Draw
@@ -16,10 +17,13 @@ st.set_page_config(page_title="Geospatial Border Alignment Engine", layout="cent
 WB_GPKG_PATH = "data/World_Bank_Official_Boundaries_Admin_0_all_layers.gpkg"
 WB_ADMIN0_LAYER = "WB_GAD_ADM0_complete"
 WB_ISO3_FIELD = "ISO_A3"
-
-# Initialize KML drivers
-if "KML" not in fiona.supported_drivers:
-    fiona.supported_drivers["KML"] = "rw"
+# Bump the version whenever the cached columns or geometry repair change
+WB_PARQUET_CACHE_PATH = "data/WB_GAD_ADM0_complete.v1.parquet"
+MAP_COORD_DECIMALS = 6
+EXPORT_COORD_DECIMALS = 7
+# Per-selection caches hold whole boundaries (tens of MB for large countries)
+BOUNDARY_CACHE_MAX_ENTRIES = 8
+CLIP_CACHE_MAX_ENTRIES = 16
 
 # --- Styling ---
 st.markdown("""
@@ -61,13 +65,23 @@ st.markdown("""
 """, unsafe_allow_html=True)
 
 
+@st.cache_resource(show_spinner=False)
+def load_country_tables():
+    """
+    Build the sorted dropdown names and a name -> ISO3 lookup in a single
+    pass over pycountry.
+    """
+    name_to_iso3 = {c.name: c.alpha_3 for c in pycountry.countries}
+    return sorted(name_to_iso3), name_to_iso3
+
+
 def get_country_iso3(country_name):
     if not country_name:
         return None
 
-    country = pycountry.countries.get(name=country_name)
-    if country:
-        return country.alpha_3
+    _, name_to_iso3 = load_country_tables()
+    if country_name in name_to_iso3:
+        return name_to_iso3[country_name]
 
     try:
         matches = pycountry.countries.search_fuzzy(country_name)
@@ -79,21 +93,65 @@ def get_country_iso3(country_name):
     return None
 
 
+def fix_geometries(geoms):
+    """
+    Repair an array of geometries with vectorized shapely calls instead of
+    cleaning them one at a time in Python, rebuilding only the invalid ones.
+    """
+    geoms = np.array(geoms, dtype=object)
+    invalid = ~shapely.is_valid(geoms)
+    if invalid.any():
+        geoms[invalid] = shapely.make_valid(geoms[invalid])
+    return geoms
+
+
 @st.cache_data(show_spinner=False)
 def load_world_bank_admin0():
     if not os.path.exists(WB_GPKG_PATH):
         return None
 
-    gdf = gpd.read_file(WB_GPKG_PATH, layer=WB_ADMIN0_LAYER)
+    if (
+        os.path.exists(WB_PARQUET_CACHE_PATH)
+        and os.path.getmtime(WB_PARQUET_CACHE_PATH) >= os.path.getmtime(WB_GPKG_PATH)
+    ):
+        # An unreadable cache falls through to the GPKG, which rewrites it
+        try:
+            return gpd.read_parquet(WB_PARQUET_CACHE_PATH)
+        except Exception:
+            pass
+
+    gdf = gpd.read_file(
+        WB_GPKG_PATH,
+        layer=WB_ADMIN0_LAYER,
+        engine="pyogrio",
+        columns=[WB_ISO3_FIELD]
+    )
 
     if gdf is None or gdf.empty:
         return None
 
     if gdf.crs is None:
         gdf = gdf.set_crs("EPSG:4326")
-    else:
+    elif not gdf.crs.equals("EPSG:4326"):
         gdf = gdf.to_crs("EPSG:4326")
 
+    gdf["geometry"] = fix_geometries(gdf.geometry.values)
+
+    # Persist the repaired layer so later cold starts skip parsing and repair;
+    # each writer gets its own temp file so concurrent cold starts can't mix
+    tmp_path = None
+    try:
+        fd, tmp_path = tempfile.mkstemp(
+            dir=os.path.dirname(WB_PARQUET_CACHE_PATH), suffix=".parquet.part"
+        )
+        os.close(fd)
+        os.chmod(tmp_path, 0o644)
+        gdf.to_parquet(tmp_path)
+        os.replace(tmp_path, WB_PARQUET_CACHE_PATH)
+    except Exception:
+        if tmp_path and os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
     return gdf
 
 
@@ -106,9 +164,9 @@ def flatten_to_multipolygon(geom):
         return None
 
     try:
-        geom = geom.buffer(0)
+        geom = shapely.make_valid(geom)
     except Exception:
-        pass
+        geom = geom.buffer(0)
 
     if geom.is_empty:
         return None
@@ -144,14 +202,25 @@ def merge_to_single_feature(gdf):
     if gdf is None or gdf.empty:
         return None
 
-    geom_series = gdf.geometry.dropna()
-    if geom_series.empty:
-        return None
-
-    try:
-        merged = geom_series.union_all()
-    except Exception:
-        merged = unary_union(list(geom_series))
+    # A single ADM0 row is already one (Multi)Polygon; otherwise missing
+    # geometries are dropped and an all-missing frame flattens to None
+    if len(gdf) == 1:
+        merged = gdf.geometry.iloc[0]
+    else:
+        geoms = np.asarray(gdf.geometry.values)
+        geoms = geoms[~shapely.is_missing(geoms)]
+
+        # Neighbouring countries share edges without overlapping, so the
+        # cheaper coverage union applies whenever that actually holds
+        # (coverage_is_valid needs shapely >= 2.1)
+        if (
+            len(geoms)
+            and hasattr(shapely, "coverage_is_valid")
+            and shapely.coverage_is_valid(geoms)
+        ):
+            merged = shapely.coverage_union_all(geoms)
+        else:
+            merged = shapely.union_all(geoms)
 
     merged = flatten_to_multipolygon(merged)
     if merged is None or merged.is_empty:
@@ -160,18 +229,19 @@ def merge_to_single_feature(gdf):
     return gpd.GeoDataFrame(geometry=[merged], crs=gdf.crs)
 
 
-@st.cache_data(show_spinner=False)
-def fetch_boundaries(country_names):
-    if not country_names:
-        return None
+def get_boundary_key(country_names):
+    """
+    Resolve a country selection to a sorted tuple of ISO3 codes, so the same
+    countries picked in any order share one set of boundary caches.
+    """
+    iso3_codes = {get_country_iso3(name) for name in country_names}
+    iso3_codes.discard(None)
+    return tuple(sorted(iso3_codes))
 
-    iso3_list = []
-    for country_name in country_names:
-        iso3 = get_country_iso3(country_name)
-        if iso3:
-            iso3_list.append(iso3)
 
-    if not iso3_list:
+@st.cache_data(show_spinner=False)
+def fetch_boundaries(iso3_codes):
+    if not iso3_codes:
         return None
 
     try:
@@ -180,7 +250,7 @@ def fetch_boundaries(country_names):
             return None
 
         result = admin0_gdf[
-            admin0_gdf[WB_ISO3_FIELD].astype(str).str.strip().str.upper().isin(iso3_list)
+            admin0_gdf[WB_ISO3_FIELD].astype(str).str.strip().str.upper().isin(iso3_codes)
         ].copy()
 
         if result.empty:
@@ -192,6 +262,187 @@ def fetch_boundaries(country_names):
         return None
 
 
+@st.cache_resource(show_spinner=False, max_entries=BOUNDARY_CACHE_MAX_ENTRIES)
+def build_boundary_index(iso3_codes):
+    """
+    Split the merged boundary into its polygon parts and index them with an
+    STRtree, built once per selection and reused for every drawing. The
+    boundary's bounds are kept alongside for map framing.
+    """
+    boundary_gdf = fetch_boundaries(iso3_codes)
+    if boundary_gdf is None:
+        return None
+
+    parts = shapely.get_parts(boundary_gdf.geometry.values)
+    return parts, shapely.STRtree(parts), boundary_gdf.total_bounds
+
+
+@st.cache_resource(show_spinner=False, max_entries=BOUNDARY_CACHE_MAX_ENTRIES)
+def build_boundary_geojson(iso3_codes):
+    """
+    Serialize the selected boundary for the map layer once per selection
+    instead of re-encoding the GeoDataFrame on every rerun. Coordinates are
+    rounded for display only; clipping uses the exact boundary.
+    """
+    boundary_gdf = fetch_boundaries(iso3_codes)
+    if boundary_gdf is None:
+        return None
+
+    display_geoms = shapely.transform(
+        boundary_gdf.geometry.values,
+        lambda coords: np.round(coords, MAP_COORD_DECIMALS)
+    )
+    return json.loads(gpd.GeoDataFrame(geometry=display_geoms, crs=boundary_gdf.crs).to_json())
+
+
+def clip_to_boundary(geom, boundary_index):
+    """
+    Intersect a drawn geometry with only the boundary parts it overlaps.
+    """
+    parts, tree, _ = boundary_index
+
+    hits = tree.query(geom, predicate="intersects")
+    if len(hits) == 0:
+        return None
+
+    # Trim candidates to the drawing's bbox so the exact overlay only sees
+    # nearby boundary vertices
+    local_parts = shapely.clip_by_rect(parts[hits], *geom.bounds)
+    pieces = shapely.intersection(local_parts, geom)
+
+    # Pieces come from disjoint boundary parts, so collect their polygons
+    # into one MultiPolygon rather than running a full union
+    polys = shapely.get_parts(shapely.get_parts(pieces))
+    polys = polys[(shapely.get_type_id(polys) == 3) & ~shapely.is_empty(polys)]
+    if len(polys) == 0:
+        return None
+
+    merged = polys[0] if len(polys) == 1 else MultiPolygon(list(polys))
+    merged = flatten_to_multipolygon(merged)
+    if merged is None:
+        return None
+
+    return gpd.GeoDataFrame(geometry=[merged], crs="EPSG:4326")
+
+
+@st.cache_data(show_spinner=False, max_entries=CLIP_CACHE_MAX_ENTRIES)
+def clip_drawing(geometry_json, iso3_codes):
+    """
+    Clip a drawing (as sorted-key GeoJSON) to the selected boundary, memoized
+    so redrawing a shape or returning to an earlier selection is instant.
+    """
+    boundary_index = build_boundary_index(iso3_codes)
+    if boundary_index is None:
+        return None
+
+    raw_shape = shape(json.loads(geometry_json))
+    if not raw_shape.is_valid:
+        return None
+
+    return clip_to_boundary(raw_shape, boundary_index)
+
+
+def kml_coordinates(ring):
+    """
+    Format a ring as a KML coordinate string with one formatting pass over
+    its numpy coordinate array rather than an f-string per vertex.
+    """
+    coords = shapely.get_coordinates(ring)
+    return " ".join(["%.15g,%.15g"] * len(coords)) % tuple(coords.ravel().tolist())
+
+
+def polygon_to_kml(polygon):
+    inner = "".join(
+        "<innerBoundaryIs><LinearRing><coordinates>"
+        f"{kml_coordinates(ring)}"
+        "</coordinates></LinearRing></innerBoundaryIs>"
+        for ring in polygon.interiors
+    )
+
+    return (
+        "<Polygon><outerBoundaryIs><LinearRing><coordinates>"
+        f"{kml_coordinates(polygon.exterior)}"
+        f"</coordinates></LinearRing></outerBoundaryIs>{inner}</Polygon>"
+    )
+
+
+def gdf_to_kml(gdf):
+    """
+    Build a single-layer KML document in memory, one Placemark per
+    Polygon / MultiPolygon row.
+    """
+    placemarks = []
+    for geom in gdf.geometry:
+        if isinstance(geom, MultiPolygon):
+            body = "".join(polygon_to_kml(p) for p in geom.geoms)
+            body = f"<MultiGeometry>{body}</MultiGeometry>"
+        else:
+            body = polygon_to_kml(geom)
+
+        placemarks.append(
+            "<Placemark>"
+            "<Style><LineStyle><color>ff0000ff</color></LineStyle>"
+            "<PolyStyle><fill>0</fill></PolyStyle></Style>"
+            f"{body}</Placemark>"
+        )
+
+    return (
+        '<?xml version="1.0" encoding="utf-8" ?>\n'
+        '<kml xmlns="http://www.opengis.net/kml/2.2">\n'
+        "<Document>\n"
+        + "\n".join(placemarks)
+        + "\n</Document></kml>\n"
+    )
+
+
+def gdf_to_geojson(gdf):
+    """
+    Build a GeoJSON FeatureCollection with GEOS's native writer, one Feature
+    per row, instead of geopandas' per-row Python serialization.
+    """
+    features = [
+        f'{{"id": "{i}", "type": "Feature", "properties": {{}}, "geometry": {geom_json}}}'
+        for i, geom_json in enumerate(shapely.to_geojson(gdf.geometry.values))
+    ]
+    return '{"type": "FeatureCollection", "features": [' + ", ".join(features) + "]}"
+
+
+def round_for_export(geoms):
+    """
+    Round coordinates to EXPORT_COORD_DECIMALS (~1 cm at 7); full float
+    precision only bloats the exports. Plain rounding can leave a polygon
+    self-intersecting, so those few are snapped to the same grid with GEOS
+    instead, which keeps them valid.
+    """
+    geoms = np.asarray(geoms)
+    rounded = shapely.transform(geoms, lambda coords: np.round(coords, EXPORT_COORD_DECIMALS))
+
+    invalid = ~shapely.is_valid(rounded)
+    if invalid.any():
+        rounded[invalid] = shapely.set_precision(
+            geoms[invalid], grid_size=10 ** -EXPORT_COORD_DECIMALS
+        )
+    return rounded
+
+
+def set_active_result(gdf):
+    """
+    Store the result with its GeoJSON and KML, serialized once and shared by
+    the map preview and the download buttons.
+    """
+    st.session_state.active_result = gdf
+
+    if gdf is None:
+        st.session_state.active_result_geojson = None
+        st.session_state.active_result_layer = None
+        st.session_state.active_result_kml = None
+    else:
+        export_gdf = gdf.set_geometry(round_for_export(gdf.geometry.values))
+        st.session_state.active_result_geojson = gdf_to_geojson(export_gdf)
+        st.session_state.active_result_layer = json.loads(st.session_state.active_result_geojson)
+        st.session_state.active_result_kml = gdf_to_kml(export_gdf).encode("utf-8")
+
+
 def build_export_name(primary_country, extra_countries):
     parts = []
 
@@ -212,7 +463,10 @@ def build_export_name(primary_country, extra_countries):
 
 # --- Persistence ---
 if "active_result" not in st.session_state:
-    st.session_state.active_result = None
+    set_active_result(None)
+
+if "last_processed_key" not in st.session_state:
+    st.session_state.last_processed_key = None
 
 if "last_selected_targets" not in st.session_state:
     st.session_state.last_selected_targets = []
@@ -229,7 +483,7 @@ if not os.path.exists(WB_GPKG_PATH):
     )
     st.stop()
 
-country_list = sorted([c.name for c in pycountry.countries])
+country_list, _ = load_country_tables()
 
 primary_country = st.selectbox(
     "Select Primary Jurisdiction",
@@ -250,13 +504,15 @@ selected_targets = [primary_country] + extra_countries if primary_country else [
 current_targets = sorted(selected_targets)
 
 if st.session_state.last_selected_targets != current_targets:
-    st.session_state.active_result = None
+    set_active_result(None)
+    st.session_state.last_processed_key = None
     st.session_state.last_selected_targets = current_targets
 
 if selected_targets:
     st.caption(f"Active boundary target: {' + '.join(selected_targets)}")
 
-boundary_gdf = fetch_boundaries(selected_targets)
+boundary_key = get_boundary_key(selected_targets)
+boundary_index = build_boundary_index(boundary_key)
 
 
 # --- Spatial Workbench (Map) ---
@@ -266,17 +522,17 @@ st.subheader("Define Area of Interest")
 if not selected_targets:
     st.info("Select a primary jurisdiction above to activate the spatial workbench.")
 
-if selected_targets and boundary_gdf is None:
+if selected_targets and boundary_index is None:
     st.warning("Could not load the selected country boundary combination from the World Bank GeoPackage.")
 
-if boundary_gdf is not None:
-    b = boundary_gdf.total_bounds
+if boundary_index is not None:
+    _, _, b = boundary_index
     map_center = [(b[1] + b[3]) / 2, (b[0] + b[2]) / 2]
     m = folium.Map(location=map_center, zoom_start=6, tiles="CartoDB Positron")
     m.fit_bounds([[b[1], b[0]], [b[3], b[2]]])
 
     folium.GeoJson(
-        boundary_gdf,
+        build_boundary_geojson(boundary_key),
         style_function=lambda x: {
             "color": "#1a1a1a",
             "fillOpacity": 0.02,
@@ -290,7 +546,7 @@ else:
 # Preview result
 if st.session_state.active_result is not None:
     folium.GeoJson(
-        st.session_state.active_result,
+        st.session_state.active_result_layer,
         style_function=lambda x: {
             "color": "#0047AB",
             "fillColor": "#0047AB",
@@ -322,26 +578,27 @@ map_interaction = st_folium(
 )
 
 # --- Processing Logic ---
-if map_interaction and map_interaction.get("all_drawings") and boundary_gdf is not None:
+if map_interaction and map_interaction.get("all_drawings") and boundary_index is not None:
     latest_drawing = map_interaction["all_drawings"][-1]
-    raw_shape = shape(latest_drawing["geometry"])
 
-    if raw_shape.is_valid:
-        input_gdf = gpd.GeoDataFrame(geometry=[raw_shape], crs="EPSG:4326")
+    # Only re-clip when the drawing or the boundary selection has changed
+    processing_key = (json.dumps(latest_drawing["geometry"], sort_keys=True), boundary_key)
 
+    if processing_key != st.session_state.last_processed_key:
         try:
-            processed_intersection = gpd.overlay(input_gdf, boundary_gdf, how="intersection")
+            final_gdf = clip_drawing(*processing_key)
 
-            if not processed_intersection.empty:
-                final_gdf = merge_to_single_feature(processed_intersection)
+            # Only mark the drawing as handled once it clipped, so a failure
+            # keeps being reported and retried on the next rerun
+            st.session_state.last_processed_key = processing_key
 
-                if final_gdf is not None:
-                    if (
-                        st.session_state.active_result is None
-                        or not final_gdf.equals(st.session_state.active_result)
-                    ):
-                        st.session_state.active_result = final_gdf
-                        st.rerun()
+            if final_gdf is not None:
+                if (
+                    st.session_state.active_result is None
+                    or not final_gdf.equals(st.session_state.active_result)
+                ):
+                    set_active_result(final_gdf)
+                    st.rerun()
 
         except Exception as e:
             st.error(f"Spatial processing failed: {e}")
@@ -354,7 +611,7 @@ def export_section():
         st.markdown("---")
         st.subheader("Export Results")
 
-        export_gdf = merge_to_single_feature(st.session_state.active_result)
+        export_gdf = st.session_state.active_result
 
         if export_gdf is None or export_gdf.empty:
             st.error("No valid geometry available for export.")
@@ -367,36 +624,25 @@ def export_section():
         with col_json:
             st.download_button(
                 label="Download GeoJSON",
-                data=export_gdf.to_json(),
+                data=st.session_state.active_result_geojson,
                 file_name=f"{final_filename}.geojson",
                 mime="application/json",
                 use_container_width=True
             )
 
         with col_kml:
-            try:
-                with tempfile.NamedTemporaryFile(delete=False, suffix=".kml") as tmp:
-                    export_gdf.to_file(tmp.name, driver="KML")
-
-                    with open(tmp.name, "rb") as f:
-                        kml_data = f.read()
-
-                st.download_button(
-                    label="Download KML",
-                    data=kml_data,
-                    file_name=f"{final_filename}.kml",
-                    mime="application/vnd.google-earth.kml+xml",
-                    use_container_width=True
-                )
-
-                os.remove(tmp.name)
-
-            except Exception as e:
-                st.error(f"KML export failed: {e}")
+            st.download_button(
+                label="Download KML",
+                data=st.session_state.active_result_kml,
+                file_name=f"{final_filename}.kml",
+                mime="application/vnd.google-earth.kml+xml",
+                use_container_width=True
+            )
 
         st.markdown('<div id="reset-button">', unsafe_allow_html=True)
         if st.button("Reset Canvas", use_container_width=True):
-            st.session_state.active_result = None
+            set_active_result(None)
+            st.session_state.last_processed_key = None
             st.rerun()
         st.markdown("</div>", unsafe_allow_html=True)
 